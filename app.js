@@ -1,12 +1,13 @@
 import express from "express";
-import { MongoClient } from "mongodb";
+import { MongoClient, ObjectId } from "mongodb";
 import dotenv from "dotenv";
 import path from "path";
 import swaggerUi from "swagger-ui-express";
 import swaggerJSDoc from "swagger-jsdoc";
 import cors from "cors";
 import crypto from "crypto";
-import bodyParser from "body-parser";
+import fs from "fs";
+import os from "os";
 import COS from "cos-nodejs-sdk-v5";
 import multer from "multer";
 import { v4 as uuidv4 } from "uuid";
@@ -22,6 +23,73 @@ const cos = new COS({
 const COS_BUCKET = process.env.TENCENT_COS_BUCKET; 
 const COS_REGION = process.env.TENCENT_COS_REGION; 
 
+/**
+ * Public URL of an object stored in the COS bucket
+ * @param {string} key - Object key
+ * @returns {string}
+ */
+function cosObjectUrl(key) {
+  return `https://${COS_BUCKET}.cos.${COS_REGION}.myqcloud.com/${key}`;
+}
+
+// === QA robocall service ===
+// const QA_ROBOCALL_URL = "https://1bbmxz17-8000.asse.devtunnels.ms/trigger_qa_robocall";
+const QA_ROBOCALL_URL = process.env.QA_ROBOCALL_URL || "https://qarobocall-production.up.railway.app/trigger_qa_robocall";
+// Per-ticket limit for /trigger_qa_robocall/pending only; keep well above real evaluation times and below QA_CLAIM_TTL_MS
+const QA_BATCH_TIMEOUT_MS = parseInt(process.env.QA_BATCH_TIMEOUT_MS) || 15 * 60 * 1000;
+// A QA claim (qa_started_at) older than this is treated as abandoned, e.g. after a restart mid-evaluation
+const QA_CLAIM_TTL_MS = parseInt(process.env.QA_CLAIM_TTL_MS) || 60 * 60 * 1000;
+
+// === ElevenLabs API ===
+const ELEVENLABS_RETRY_STATUSES = new Set([429, 500, 502, 503, 504]);
+
+/**
+ * Parse a Retry-After header (delay in seconds or an HTTP date)
+ * @param {string|null} value
+ * @returns {number|null} Delay in milliseconds, or null if absent/invalid
+ */
+function parseRetryAfter(value) {
+  if (!value) return null;
+  value = value.trim();
+  if (/^\d+$/.test(value)) return Number(value) * 1000;
+  // HTTP dates start with a day name ("Wed, 21 Oct 2015 07:28:00 GMT"); anything else, e.g. "1.5", is invalid
+  if (!/^[A-Za-z]{3}/.test(value)) return null;
+  const ms = Date.parse(value) - Date.now();
+  return Number.isNaN(ms) ? null : Math.max(ms, 0);
+}
+
+/**
+ * GET from the ElevenLabs API with bounded retries on 429/5xx and network errors
+ * Each attempt times out after timeoutMs and timeouts are not retried; retries (honouring Retry-After)
+ * only happen while they fit within deadlineMs, otherwise the last response or error is returned
+ * @param {string} url
+ * @param {object} options - fetch options (headers, ...)
+ * @param {object} [retry] - { retries, backoffMs, timeoutMs, deadlineMs }
+ * @returns {Promise<Response>} The last response received
+ */
+async function fetchElevenLabs(url, options, { retries = 3, backoffMs = 200, timeoutMs = 10 * 1000, deadlineMs = 15 * 1000 } = {}) {
+  const deadline = Date.now() + deadlineMs;
+  for (let attempt = 0; ; attempt++) {
+    let response;
+    try {
+      const remaining = Math.max(deadline - Date.now(), 1);
+      response = await fetch(url, { ...options, method: "GET", signal: AbortSignal.timeout(Math.min(timeoutMs, remaining)) });
+    } catch (err) {
+      // A stalled API would stall every retry too, so fail fast on timeouts
+      if (err.name === "TimeoutError" || attempt >= retries) throw err;
+      const delay = backoffMs * 2 ** attempt;
+      if (Date.now() + delay >= deadline) throw err;
+      await new Promise((resolve) => setTimeout(resolve, delay));
+      continue;
+    }
+    if (!ELEVENLABS_RETRY_STATUSES.has(response.status) || attempt >= retries) return response;
+    const delay = parseRetryAfter(response.headers.get("retry-after")) ?? backoffMs * 2 ** attempt;
+    if (Date.now() + delay >= deadline) return response;
+    await response.body?.cancel(); // release the pooled connection before retrying
+    await new Promise((resolve) => setTimeout(resolve, delay));
+  }
+}
+
 const app = express();
 const PORT = process.env.PORT || 3001;
 
@@ -204,6 +272,7 @@ async function create_robocall_ticket(event) {
       call_transcription,
       ticket_status: "closed",
       eval: null,
+      qa_started_at: now, // QA is triggered right after, see triggerQaRobocall
       updated_at: now
     };
     await robocallTicketsCollection.updateOne(
@@ -224,6 +293,7 @@ async function create_robocall_ticket(event) {
       customer_name,
       priority,
       eval: null,
+      qa_started_at: now, // QA is triggered right after, see triggerQaRobocall
       call_transcription,
       created_at: now // Add created_at for new tickets
     };
@@ -339,8 +409,6 @@ app.post("/webhook/robocall-ticket", express.json(), async (req, res) => {
  * Query param: agent_id (optional), ticket_number (optional)
  * Returns all tickets, or those matching call_transcription.data.agent_id or ticket_number
  */
-import { ObjectId } from "mongodb";
-
 app.get("/api/robocall-tickets", async (req, res) => {
   try {
     let { agent_id, ticket_number, sort } = req.query;
@@ -427,6 +495,73 @@ app.get("/api/robocall-tickets", async (req, res) => {
  *       500:
  *         description: Server error.
  */
+/**
+ * Send a ticket to the QA robocall service and store the evaluation result on the ticket
+ * @param {object} ticketData - Ticket document; _id may be a string, { $oid } or an ObjectId
+ * @param {object} [options] - { timeoutMs }; without timeoutMs the call waits for the QA service
+ * @returns {Promise<object>} The QA service response
+ */
+async function evaluateTicket(ticketData, { timeoutMs } = {}) {
+  const response = await fetch(QA_ROBOCALL_URL, {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+    },
+    body: JSON.stringify(ticketData),
+    signal: timeoutMs ? AbortSignal.timeout(timeoutMs) : undefined,
+  });
+
+  if (!response.ok) {
+    const errorText = await response.text();
+    console.error(`Failed to trigger QA robocall: ${response.status} - ${errorText}`);
+    const err = new Error(`Failed to trigger QA robocall: ${errorText}`);
+    err.status = response.status;
+    throw err;
+  }
+
+  const result = await response.json();
+  console.log("QA robocall triggered successfully:", result);
+
+  // Update the robocall ticket with the evaluation result
+  const ticketId = ticketData._id instanceof ObjectId
+    ? ticketData._id
+    : typeof ticketData._id === 'string' ? new ObjectId(ticketData._id) : new ObjectId(ticketData._id.$oid);
+  await robocallTicketsCollection.updateOne(
+    { _id: ticketId },
+    { $set: { eval: result.evaluation_result, updated_at: new Date() } }
+  );
+  console.log(`Updated robocall ticket ${ticketData._id} with QA evaluation result.`);
+
+  return result;
+}
+
+/**
+ * Filter for tickets still waiting for QA that no one is currently evaluating
+ * @returns {object} MongoDB filter
+ */
+function pendingQaFilter() {
+  return {
+    eval: null,
+    $or: [
+      { qa_started_at: null },
+      { qa_started_at: { $lt: new Date(Date.now() - QA_CLAIM_TTL_MS) } }
+    ]
+  };
+}
+
+/**
+ * Atomically mark a pending ticket as being evaluated
+ * @param {ObjectId} _id
+ * @returns {Promise<object|null>} The claimed ticket, or null if it was already evaluated or in flight
+ */
+async function claimTicketForQa(_id) {
+  return robocallTicketsCollection.findOneAndUpdate(
+    { _id, ...pendingQaFilter() },
+    { $set: { qa_started_at: new Date() } },
+    { returnDocument: "after" }
+  );
+}
+
 app.post("/trigger_qa_robocall", express.json(), async (req, res) => {
   const ticketData = req.body;
   if (!ticketData || !ticketData._id) {
@@ -434,36 +569,107 @@ app.post("/trigger_qa_robocall", express.json(), async (req, res) => {
   }
 
   try {
-    // const qaRobocallUrl = "https://1bbmxz17-8000.asse.devtunnels.ms/trigger_qa_robocall";
-    const qaRobocallUrl = "https://qarobocall-production.up.railway.app/trigger_qa_robocall";
-    const response = await fetch(qaRobocallUrl, {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-      },
-      body: JSON.stringify(ticketData),
-    });
+    const result = await evaluateTicket(ticketData);
+    res.status(200).json(result);
+  } catch (err) {
+    if (err.status) {
+      return res.status(err.status).json({ error: err.message });
+    }
+    console.error("Error triggering QA robocall:", err);
+    res.status(500).json({ error: "Server error when triggering QA robocall" });
+  }
+});
 
-    if (!response.ok) {
-      const errorText = await response.text();
-      console.error(`Failed to trigger QA robocall: ${response.status} - ${errorText}`);
-      return res.status(response.status).json({ error: `Failed to trigger QA robocall: ${errorText}` });
+/**
+ * Evaluate pending tickets, running up to QA_MAX_CONCURRENCY evaluations at a time
+ * @param {Array<object>} tickets - Candidate tickets ({ _id, ticket_number }); each is claimed before evaluation
+ * @returns {Promise<object>} { evaluated, skipped, failed }
+ */
+async function runPendingQaBatch(tickets) {
+  const concurrency = Math.max(parseInt(process.env.QA_MAX_CONCURRENCY) || 16, 1);
+  const failed = [];
+  let evaluated = 0, skipped = 0, next = 0;
+  const workers = Array.from({ length: Math.min(concurrency, tickets.length) }, async () => {
+    while (next < tickets.length) {
+      const { _id, ticket_number } = tickets[next++];
+      let claimed = null;
+      try {
+        // Claim before evaluating so overlapping batches and webhook-triggered QA don't evaluate twice
+        claimed = await claimTicketForQa(_id);
+        if (!claimed) {
+          skipped++;
+          continue;
+        }
+        const { qa_started_at, ...ticket } = claimed;
+        await evaluateTicket(ticket, { timeoutMs: QA_BATCH_TIMEOUT_MS });
+        evaluated++;
+      } catch (err) {
+        console.error(`QA evaluation failed for ticket ${ticket_number}:`, err);
+        failed.push({ ticket_number, error: err.message });
+        // Nothing to release if the claim itself failed. The QA service may still be working on a
+        // timed-out ticket, so leave that claim for QA_CLAIM_TTL_MS to expire
+        if (!claimed || err.name === "TimeoutError") continue;
+      }
+      try {
+        await robocallTicketsCollection.updateOne({ _id }, { $unset: { qa_started_at: "" } });
+      } catch (err) {
+        console.error("Failed to clear QA claim for ticket", ticket_number, err);
+      }
     }
+  });
+  await Promise.all(workers);
+  return { evaluated, skipped, failed };
+}
 
-    const result = await response.json();
-    console.log("QA robocall triggered successfully:", result);
+/**
+ * @openapi
+ * /trigger_qa_robocall/pending:
+ *   post:
+ *     summary: Queues QA robocall evaluations for tickets where eval is null.
+ *     description: |
+ *       Responds immediately and evaluates the tickets in the background, running up to
+ *       QA_MAX_CONCURRENCY (default 16) evaluations at a time. Tickets already being evaluated are skipped.
+ *     parameters:
+ *       - in: query
+ *         name: limit
+ *         schema:
+ *           type: integer
+ *         description: Maximum number of pending tickets to evaluate (default 100, max 1000)
+ *     responses:
+ *       202:
+ *         description: Batch accepted.
+ *         content:
+ *           application/json:
+ *             schema:
+ *               type: object
+ *               properties:
+ *                 message:
+ *                   type: string
+ *                 queued:
+ *                   type: integer
+ *       500:
+ *         description: Server error.
+ */
+app.post("/trigger_qa_robocall/pending", async (req, res) => {
+  try {
+    let { limit } = req.query;
+    limit = Math.min(parseInt(limit) || 100, 1000); // Default to 100, max 1000
+    const tickets = await robocallTicketsCollection
+      .find(pendingQaFilter(), { projection: { _id: 1, ticket_number: 1 } })
+      .sort({ _id: 1 })
+      .limit(limit)
+      .toArray();
 
-    // Update the robocall ticket with the evaluation result
-    const ticketId = typeof ticketData._id === 'string' ? new ObjectId(ticketData._id) : new ObjectId(ticketData._id.$oid);
-    await robocallTicketsCollection.updateOne(
-      { _id: ticketId },
-      { $set: { eval: result.evaluation_result, updated_at: new Date() } }
-    );
-    console.log(`Updated robocall ticket ${ticketData._id} with QA evaluation result.`);
+    res.status(202).json({ message: "QA evaluations queued", queued: tickets.length });
 
-    res.status(200).json(result);
+    // Run the batch in the background (non-blocking); it can take far longer than a request timeout
+    runPendingQaBatch(tickets)
+      .then(({ evaluated, skipped, failed }) => {
+        console.log(`Pending QA batch done: ${evaluated} evaluated, ${skipped} skipped, ${failed.length} failed`);
+      })
+      .catch((err) => console.error("Pending QA batch failed:", err));
   } catch (err) {
-    console.error("Error triggering QA robocall:", err);
+    console.error("Error triggering pending QA robocalls:", err);
     res.status(500).json({ error: "Server error when triggering QA robocall" });
   }
 });
@@ -472,13 +678,13 @@ app.post("/trigger_qa_robocall", express.json(), async (req, res) => {
 /**
  * GET /api/robocall-tickets/pending-eval
  * Query: limit (default 100, max 1000), after_id (ObjectId as string)
- * Returns a page of tickets where eval is null, sorted by _id ascending
+ * Returns a page of tickets where eval is null and no QA evaluation is in flight, sorted by _id ascending
  */
 app.get("/api/robocall-tickets/pending-eval", async (req, res) => {
   try {
     let { limit } = req.query;
     limit = Math.min(parseInt(limit) || 1000, 1000); // Default to 1000, max 1000
-    const query = { eval: null };
+    const query = pendingQaFilter();
     const tickets = await robocallTicketsCollection
       .find(query)
       .sort({ _id: 1 })
@@ -492,7 +698,7 @@ app.get("/api/robocall-tickets/pending-eval", async (req, res) => {
 
 app.post(
   "/webhook/elevenlabs/postcall",
-  bodyParser.raw({ type: "application/json", limit: "20mb" }),
+  express.raw({ type: "application/json", limit: "20mb" }),
   async (req, res) => {
     console.log("POST /webhook/elevenlabs/postcall called");
     try {
@@ -521,17 +727,14 @@ app.post(
         return res.status(403).json({ error: "Request expired" });
       }
       // Validate HMAC
-      // Log raw body and message for debugging
-      console.log("Raw body (hex):", req.body.toString("hex"));
-      // Use raw buffer for HMAC calculation
-      const message = Buffer.concat([
-        Buffer.from(timestamp + ".", "utf-8"),
-        req.body
-      ]);
-      // console.log("HMAC message (buffer):", message);
       // Masked secret info for debugging
       console.log("Secret info: length =", secret.length, "first char =", secret[0], "last char =", secret[secret.length-1]);
-      const digest = "v0=" + crypto.createHmac("sha256", secret).update(message).digest("hex");
+      // Feed "<timestamp>." and the raw body buffer into the HMAC separately instead of concatenating
+      // (post_call_audio bodies carry the full base64 audio and can be up to 20mb)
+      const digest = "v0=" + crypto.createHmac("sha256", secret)
+        .update(timestamp + ".", "utf-8")
+        .update(req.body)
+        .digest("hex");
       if (signature !== digest) {
         console.error("Invalid signature", { signature, digest });
         return res.status(401).json({ error: "Invalid signature" });
@@ -539,13 +742,12 @@ app.post(
       // Parse JSON
       let event;
       try {
-        const bodyString = req.body.toString("utf-8");
-        event = JSON.parse(bodyString);
+        event = JSON.parse(req.body.toString("utf-8"));
       } catch (e) {
-        console.error("Invalid JSON", req.body.toString("utf-8"));
+        console.error("Invalid JSON", e.message);
         return res.status(400).json({ error: "Invalid JSON" });
       }
-      console.log("Parsed event:", event);
+      console.log("Parsed event:", event.type, event.data?.conversation_id);
 
       // Handle both post_call_transcription and post_call_audio
       if (event.type === "post_call_transcription") {
@@ -596,7 +798,7 @@ app.post(
                 return res.status(500).json({ error: "Failed to upload audio to COS", details: err });
               }
               // Success
-              const fileUrl = `https://${COS_BUCKET}.cos.${COS_REGION}.myqcloud.com/${key}`;
+              const fileUrl = cosObjectUrl(key);
               // Store metadata in MongoDB
               try {
                 await postcallCollection.insertOne({
@@ -695,12 +897,10 @@ app.get("/api/signed-url/:slug", async (req, res) => {
       console.error("Missing agent_id or apiKey for assistant:", assistant); // Debugging line
       return res.status(500).json({ error: "Missing agent_id or apiKey for this assistant" });
     }
-    // Request signed URL from ElevenLabs
-    const fetch = (await import("node-fetch")).default;
-    const response = await fetch(
+    // Request signed URL from ElevenLabs (global fetch reuses pooled keep-alive connections)
+    const response = await fetchElevenLabs(
       `https://api.elevenlabs.io/v1/convai/conversation/get-signed-url?agent_id=${assistant.agent_id}`,
       {
-        method: "GET",
         headers: {
           "xi-api-key": assistant.apiKey,
         },
@@ -757,7 +957,8 @@ app.get("/api/signed-url/:slug", async (req, res) => {
  *         description: Server error
  */
 const upload = multer({
-  storage: multer.memoryStorage(),
+  // Spool uploads to a temp file and stream them to COS instead of holding the whole file in memory
+  storage: multer.diskStorage({ destination: os.tmpdir() }),
   fileFilter: (req, file, cb) => {
     // Accept any audio file
     if (!file.mimetype.startsWith("audio/")) {
@@ -770,6 +971,8 @@ const upload = multer({
 
 /**
  * Trigger QA robocall in the background (non-blocking)
+ * Clears the ticket's qa_started_at claim once the QA service has responded; if the call fails
+ * the claim is left for QA_CLAIM_TTL_MS to expire, since the QA service may still be working on it
  * @param {string} ticket_number
  * @param {string} agent_id
  * @param {string} conversation_id
@@ -777,22 +980,28 @@ const upload = multer({
 function triggerQaRobocall(ticket_number, agent_id, conversation_id) {
   (async () => {
     try {
-      // const qaRobocallUrl = "https://1bbmxz17-8000.asse.devtunnels.ms/trigger_qa_robocall";
-      const qaRobocallUrl = "https://qarobocall-production.up.railway.app/trigger_qa_robocall";
+      // Callers create the ticket with qa_started_at set, so /trigger_qa_robocall/pending skips it meanwhile
       const qaPayload = {
         ticket_number,
         agent_id,
         conversation_id
       };
-      await fetch(qaRobocallUrl, {
+      const response = await fetch(QA_ROBOCALL_URL, {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
         },
         body: JSON.stringify(qaPayload),
       });
+      await response.text(); // wait for the QA service to finish responding
     } catch (qaErr) {
       console.error("Failed to trigger QA robocall after upload-audio:", qaErr);
+      return;
+    }
+    try {
+      await robocallTicketsCollection.updateOne({ ticket_number }, { $unset: { qa_started_at: "" } });
+    } catch (err) {
+      console.error("Failed to clear QA claim for ticket", ticket_number, err);
     }
   })();
 }
@@ -834,15 +1043,17 @@ app.post("/api/upload-audio", upload.single("file"), async (req, res) => {
         Bucket: COS_BUCKET,
         Region: COS_REGION,
         Key: key,
-        Body: req.file.buffer,
+        Body: fs.createReadStream(req.file.path),
+        ContentLength: req.file.size,
         ContentType: req.file.mimetype,
       },
       (err, data) => {
+        fs.unlink(req.file.path, () => {});
         if (err) {
           console.error("COS upload error:", err);
           return res.status(500).json({ error: "Failed to upload file to COS", details: err });
         }
-        const fileUrl = `https://${COS_BUCKET}.cos.${COS_REGION}.myqcloud.com/${key}`;
+        const fileUrl = cosObjectUrl(key);
 
         // After successful upload, generate ticket and store in DB
         (async () => {
@@ -850,6 +1061,7 @@ app.post("/api/upload-audio", upload.single("file"), async (req, res) => {
             const ticket_number = await generateUniqueTicketNumber(robocallTicketsCollection);
             await robocallTicketsCollection.insertOne({
               ticket_number,
+              qa_started_at: new Date(), // QA is triggered right after, see triggerQaRobocall
               call_transcription: {
                 data: {
                   agent_id,
@@ -877,6 +1089,7 @@ app.post("/api/upload-audio", upload.single("file"), async (req, res) => {
       }
     );
   } catch (err) {
+    if (req.file?.path) fs.unlink(req.file.path, () => {});
     console.error("Error in /api/upload-audio-call:", err);
     res.status(500).json({ error: "Server error" });
   }